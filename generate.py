@@ -4,15 +4,22 @@ Image Generation Script for Claude Code
 Supports: OpenRouter (Gemini Nano Banana) + Direct OpenAI (gpt-image-1.5)
 """
 
-import argparse
-import base64
+import binascii
+import functools
+import itertools
 import json
+import mmap
 import os
 import sys
-import time
-from datetime import datetime
+import threading
 from pathlib import Path
 
+# orjson (C, SIMD) is much faster than stdlib json for multi-MB image payloads
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # === Venv Bootstrap ===
 # Ensures script runs in its own venv regardless of how it's invoked
 SKILL_DIR = Path(__file__).parent.resolve()
@@ -20,20 +27,77 @@ VENV_PYTHON = SKILL_DIR / ".venv" / "bin" / "python3"
 
 def _ensure_venv():
     """Re-exec with venv Python if we're not already in it."""
+    # Plain string compare first; only resolve symlinks when the paths differ
+    if sys.executable == str(VENV_PYTHON):
+        return
     if VENV_PYTHON.exists() and Path(sys.executable).resolve() != VENV_PYTHON.resolve():
+        # Tell the re-exec'd process it's already in the venv so it skips this check
+        os.environ["IMAGEGEN_VENV_OK"] = "1"
         os.execv(str(VENV_PYTHON), [str(VENV_PYTHON)] + sys.argv)
 
-_ensure_venv()
+if os.environ.get("IMAGEGEN_VENV_OK") != "1":
+    _ensure_venv()
 
 # === Configuration ===
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MAX_RETRIES = 3
 RETRY_BACKOFF_BASE = 2  # seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Base64 is decoded in chunks that map to whole 4-char groups
+B64_DECODE_CHUNK = 64 * 1024  # chars, multiple of 4
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENAI_GENERATIONS_URL = "https://api.openai.com/v1/images/generations"
+OPENAI_EDITS_URL = "https://api.openai.com/v1/images/edits"
+OPENROUTER_ORIGIN = "https://openrouter.ai/"
+OPENAI_ORIGIN = "https://api.openai.com/"
+PREWARM_WAIT = 1.0  # seconds a request waits for an in-flight warm-up to finish
+
+# Per-process image counter; with the PID in the name, filenames never collide
+_image_counter = itertools.count(1)
+
+# Serializes session file writes from parallel generate() calls
+_session_lock = threading.Lock()
+
+# One pooled HTTP session per API key, so repeat calls reuse keep-alive connections
+_SESSIONS = {}
+_clients_lock = threading.Lock()
+
+# In-flight connection warm-up threads, by API key
+_prewarm_threads = {}
+
+# Opt-in HTTP/2 (via httpx): concurrent requests multiplex over one connection per host
+HTTP2_ENABLED = os.getenv("IMAGEGEN_HTTP2") == "1"
+_HTTP2_CLIENTS = {}
+
+def _json_loads(data: bytes):
+    """Parse JSON from bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
+def _json_dumps(obj, indent: bool = False) -> bytes:
+    """Serialize to UTF-8 JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+
+@functools.cache
+def get_project_dir() -> Path:
+    """Get the project directory (cwd, which can't change during a run)."""
+    return Path.cwd()
+
+@functools.cache
 def get_session_file() -> Path:
     """Get project-local session file path."""
-    return Path.cwd() / ".image-gen-session.json"
+    return get_project_dir() / ".image-gen-session.json"
+
+@functools.cache
+def get_history_file() -> Path:
+    """Get project-local generation history log path."""
+    return get_project_dir() / ".image-gen-history.jsonl"
 
 MODELS = {
     # OpenRouter models (Gemini)
@@ -47,7 +111,23 @@ MODELS = {
 
 DEFAULT_MODEL = "nano-banana-pro"
 
+IMAGE_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
 
+# Prompt keywords used by smart model selection
+TRANSPARENCY_KEYWORDS = ("transparent", "transparency", "png with alpha",
+                         "no background", "remove background", "cutout",
+                         "isolated on", "white background", "clear background")
+TEXT_KEYWORDS = ("text", "typography", "lettering", "words", "title",
+                 "heading", "sign", "poster with text", "logo with text",
+                 "banner", "quote", "writing")
+FAST_KEYWORDS = ("quick", "draft", "rough", "sketch", "fast", "test")
+HIGHRES_KEYWORDS = ("4k", "high res", "high resolution", "detailed",
+                    "print quality", "large format", "poster", "wallpaper")
+
+
+# Cached: batches repeat prompts, and main() runs the same lookup as _resolve_model()
+# when it picks a provider to prewarm
+@functools.lru_cache(maxsize=256)
 def select_model(prompt: str, transparent: bool = False, high_res: bool = False,
                  fast: bool = False, text_heavy: bool = False) -> str:
     """
@@ -64,28 +144,19 @@ def select_model(prompt: str, transparent: bool = False, high_res: bool = False,
     prompt_lower = prompt.lower()
 
     # Check for transparency keywords
-    transparency_keywords = ["transparent", "transparency", "png with alpha",
-                            "no background", "remove background", "cutout",
-                            "isolated on", "white background", "clear background"]
-    if transparent or any(kw in prompt_lower for kw in transparency_keywords):
+    if transparent or any(kw in prompt_lower for kw in TRANSPARENCY_KEYWORDS):
         return "gpt-image-1.5"
 
     # Check for text-heavy content
-    text_keywords = ["text", "typography", "lettering", "words", "title",
-                    "heading", "sign", "poster with text", "logo with text",
-                    "banner", "quote", "writing"]
-    if text_heavy or any(kw in prompt_lower for kw in text_keywords):
+    if text_heavy or any(kw in prompt_lower for kw in TEXT_KEYWORDS):
         return "gpt-image-1.5"
 
     # Check for fast/draft mode
-    fast_keywords = ["quick", "draft", "rough", "sketch", "fast", "test"]
-    if fast or any(kw in prompt_lower for kw in fast_keywords):
+    if fast or any(kw in prompt_lower for kw in FAST_KEYWORDS):
         return "nano-banana"  # Faster, still good quality
 
     # Check for high resolution needs
-    highres_keywords = ["4k", "high res", "high resolution", "detailed",
-                       "print quality", "large format", "poster", "wallpaper"]
-    if high_res or any(kw in prompt_lower for kw in highres_keywords):
+    if high_res or any(kw in prompt_lower for kw in HIGHRES_KEYWORDS):
         return "nano-banana-pro"
 
     # Default to nano-banana-pro for best overall quality
@@ -93,35 +164,77 @@ def select_model(prompt: str, transparent: bool = False, high_res: bool = False,
 
 
 def load_session():
-    """Load current session state."""
+    """Load current session state (current image and output dir)."""
     session_file = get_session_file()
-    if session_file.exists():
-        return json.loads(session_file.read_text())
-    return {"current_image": None, "history": [], "output_dir": None}
+    if not session_file.exists():
+        return {"current_image": None, "output_dir": None}
+
+    session = _json_loads(session_file.read_bytes())
+    # Older sessions kept history inline; move it to the history log once
+    history = session.pop("history", None)
+    if history:
+        append_history(history)
+    if history is not None:
+        save_session(session)
+    return session
 
 
 def save_session(session):
-    """Save session state."""
-    get_session_file().write_text(json.dumps(session, indent=2))
+    """Save session state atomically, so a crash mid-write can't corrupt it."""
+    session_file = get_session_file()
+    # Per-process temp name, so concurrent runs in one project never share it
+    tmp_file = session_file.with_name(f"{session_file.name}.{os.getpid()}.tmp")
+    with _session_lock:
+        tmp_file.write_bytes(_json_dumps(session, indent=True))
+        os.replace(tmp_file, session_file)
+
+
+def update_session(**changes) -> dict:
+    """Merge changes into the saved session state, skipping the write if nothing changed."""
+    session = load_session()
+    if any(session.get(key) != value for key, value in changes.items()):
+        session.update(changes)
+        save_session(session)
+    return session
+
+
+def append_history(entries: list[dict]):
+    """Append generation records to the history log, one JSON object per line."""
+    with open(get_history_file(), "ab") as f:
+        f.writelines(_json_dumps(entry) + b"\n" for entry in entries)
+
+
+def read_history_summary() -> tuple[int, dict]:
+    """Return the number of history entries and the most recent one."""
+    count, last_line = 0, None
+    history_file = get_history_file()
+    if history_file.exists():
+        with open(history_file, "rb") as f:
+            for count, last_line in enumerate(f, 1):
+                pass
+    return count, _json_loads(last_line) if last_line else None
 
 
 def clear_session():
-    """Clear session state."""
+    """Clear session state and history."""
     session_file = get_session_file()
-    if session_file.exists():
-        session_file.unlink()
+    session_file.unlink(missing_ok=True)
+    get_history_file().unlink(missing_ok=True)
     print(f"Session cleared: {session_file}")
 
 
-def image_to_base64(image_path: str) -> tuple[str, str]:
-    """Convert image file to base64 with mime type."""
+def image_to_base64(image_path: str) -> tuple[bytes, str]:
+    """Convert image file to base64 (ASCII bytes) with mime type."""
     path = Path(image_path)
     suffix = path.suffix.lower()
-    mime_map = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
-    mime_type = mime_map.get(suffix, "image/png")
+    mime_type = IMAGE_MIME_TYPES.get(suffix, "image/png")
 
-    with open(path, "rb") as f:
-        data = base64.b64encode(f.read()).decode("utf-8")
+    if path.stat().st_size == 0:
+        raise ValueError(f"Image file is empty: {path}")
+
+    # Encode straight from a memory map, skipping the intermediate f.read() copy
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        data = binascii.b2a_base64(m, newline=False)
     return data, mime_type
 
 
@@ -145,37 +258,343 @@ def save_image(base64_data: str, output_dir: Path, prefix: str = "gen") -> Path:
         ext = ext_map.get(mime_type, "png")
 
     # Generate unique filename
+    from datetime import datetime
+
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    existing = list(output_dir.glob(f"{prefix}_{timestamp}_*.{ext}"))
-    index = len(existing) + 1
-    filename = f"{prefix}_{timestamp}_{index:03d}.{ext}"
+    index = next(_image_counter)
+    filename = f"{prefix}_{timestamp}_{os.getpid()}_{index:03d}.{ext}"
 
     output_path = output_dir / filename
 
-    with open(output_path, "wb") as f:
-        f.write(base64.b64decode(base64_data))
+    # Decode straight into the file in chunks instead of materializing all image bytes.
+    # Whitespace (MIME line breaks) is dropped and any partial 4-char quantum is
+    # carried into the next chunk so every slice decodes on its own.
+    try:
+        with open(output_path, "wb") as f:
+            pending = ""
+            for i in range(0, len(base64_data), B64_DECODE_CHUNK):
+                pending += "".join(base64_data[i:i + B64_DECODE_CHUNK].split())
+                cut = len(pending) - len(pending) % 4
+                f.write(binascii.a2b_base64(pending[:cut]))
+                pending = pending[cut:]
+            if pending:
+                f.write(binascii.a2b_base64(pending))
+    except (binascii.Error, ValueError):
+        output_path.unlink(missing_ok=True)
+        raise
 
     return output_path
 
 
-def generate_openrouter(prompt: str, model: str, input_image: str = None,
-                         aspect_ratio: str = None, image_size: str = None) -> str:
-    """Generate image using OpenRouter (Gemini models)."""
+def _get_session(api_key: str):
+    """Get (or lazily create) the pooled HTTP session for an API key."""
+    session = _SESSIONS.get(api_key)
+    if session is None:
+        # Locked so a warm-up thread and the real request can't each build one
+        with _clients_lock:
+            session = _SESSIONS.get(api_key)
+            if session is None:
+                try:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    from urllib3.util import Retry
+                except ImportError:
+                    raise ImportError("requests not installed. Run: pip install requests")
+
+                # Transient network errors and 429/5xx are retried in the transport with
+                # jittered exponential backoff, honoring the server's Retry-After header
+                retry = Retry(
+                    total=MAX_RETRIES,
+                    backoff_factor=RETRY_BACKOFF_BASE,
+                    backoff_jitter=0.3,
+                    status_forcelist=RETRY_STATUS_CODES,
+                    allowed_methods=frozenset(["POST"]),
+                    respect_retry_after_header=True,
+                    raise_on_status=False,
+                )
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+                session.mount("https://", adapter)
+                session.headers.update({
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json",
+                })
+                _SESSIONS[api_key] = session
+    return session
+
+
+def _get_http2_client(api_key: str):
+    """Get (or lazily create) the pooled HTTP/2 httpx client for an API key."""
+    client = _HTTP2_CLIENTS.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _HTTP2_CLIENTS.get(api_key)
+            if client is None:
+                try:
+                    import httpx
+                except ImportError:
+                    raise ImportError("httpx not installed. Run: pip install 'httpx[http2]'")
+
+                # Transport errors and 429/5xx are retried in _post
+                transport = httpx.HTTPTransport(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=8, max_keepalive_connections=8),
+                )
+                client = httpx.Client(
+                    transport=transport,
+                    timeout=120,
+                    headers={"Authorization": f"Bearer {api_key}"},
+                )
+                _HTTP2_CLIENTS[api_key] = client
+    return client
+
+
+def _retry_delay(attempt: int, retry_after: str = None) -> float:
+    """Backoff before the next retry, honoring a numeric Retry-After header."""
+    import random
+
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return RETRY_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, 0.3)
+
+
+def _prewarm_session(model_alias: str):
+    """
+    Open the connection to a model's API host in a background thread, so the
+    TLS handshake overlaps startup and the first request reuses it.
+    """
+    if model_alias.startswith("gpt-"):
+        url, api_key = OPENAI_ORIGIN, OPENAI_API_KEY
+    else:
+        url, api_key = OPENROUTER_ORIGIN, OPENROUTER_API_KEY
+    if not api_key or api_key in _prewarm_threads:
+        return
+
+    def prewarm():
+        try:
+            client = _get_http2_client(api_key) if HTTP2_ENABLED else _get_session(api_key)
+            client.head(url, timeout=5)
+        except Exception:
+            pass  # Best effort; the real request connects and reports errors itself
+
+    thread = threading.Thread(target=prewarm, daemon=True)
+    thread.start()
+    _prewarm_threads[api_key] = thread
+
+
+# Options of generate/edit that take a value; "--opt=value" and "-oVALUE" forms are single args
+_PREWARM_VALUE_OPTIONS = ("-o", "--output", "--aspect-ratio", "--size", "-i", "--input")
+
+
+def _prewarm_from_argv(argv: list[str]):
+    """
+    Start a connection warm-up from the raw command line, before argparse runs.
+
+    Only warms when the provider is certain: an explicit model, or the same
+    select_model() call _resolve_model() makes later (cached, so it runs once).
+    Anything the scan can't read exactly (help, unknown or abbreviated options)
+    skips the warm-up rather than guessing.
+    """
+    if not argv or argv[0] not in ("generate", "gen", "g", "edit", "e"):
+        return
+    if "-h" in argv or "--help" in argv:
+        return
+
+    prompt = None
+    model_alias = None
+    image_size = None
+    transparent = fast = False
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--":
+            prompt = prompt if prompt is not None else next(args, None)
+            break
+        if arg in ("-m", "--model"):
+            model_alias = next(args, None)
+        elif arg.startswith("--model="):
+            model_alias = arg.split("=", 1)[1]
+        elif arg == "--image-size":
+            image_size = next(args, None)
+        elif arg.startswith("--image-size="):
+            image_size = arg.split("=", 1)[1]
+        elif arg == "--transparent":
+            transparent = True
+        elif arg == "--fast":
+            fast = True
+        elif arg in _PREWARM_VALUE_OPTIONS:
+            next(args, None)
+        elif arg.startswith("--"):
+            if arg.split("=", 1)[0] not in _PREWARM_VALUE_OPTIONS:
+                return
+        elif arg.startswith("-") and len(arg) > 1:
+            if arg[:2] == "-m":
+                model_alias = arg[2:]
+            elif arg[:2] not in _PREWARM_VALUE_OPTIONS:
+                return
+        elif prompt is None:
+            prompt = arg
+
+    if model_alias is None or model_alias == "auto":
+        if prompt is None:
+            return
+        model_alias = select_model(prompt, transparent=transparent, fast=fast,
+                                   high_res=(image_size == "4K"))
+    if model_alias in MODELS:
+        _prewarm_session(model_alias)
+
+
+def _wait_for_prewarm(api_key: str):
+    """Briefly wait for an in-flight warm-up so the request reuses its connection."""
+    thread = _prewarm_threads.pop(api_key, None)
+    if thread is not None:
+        thread.join(PREWARM_WAIT)
+
+
+def _error_detail(body: bytes) -> str:
+    """Extract the provider's error message from a failed response body."""
     try:
-        import requests
+        result = _json_loads(body)
+    except ValueError:
+        result = None
+    detail = result.get("error") if isinstance(result, dict) else None
+    if isinstance(detail, dict):
+        detail = detail.get("message") or detail
+    return str(detail or body.decode("utf-8", "replace"))
+
+
+def _raise_for_status(response):
+    """
+    Raise HTTPError for a failed API response, including the provider's error message.
+
+    Accepts requests and httpx responses, so both transports fail the same way.
+    """
+    import requests
+
+    status = response.status_code
+    if status < 400:
+        return
+    kind = "Client" if status < 500 else "Server"
+    reason = getattr(response, "reason", None) or getattr(response, "reason_phrase", "")
+    raise requests.HTTPError(f"{status} {kind} Error: {reason} for url: {response.url}: "
+                             f"{_error_detail(response.content)}", response=response)
+
+
+class _MultipartUpload:
+    """
+    Streamed multipart body (requests-toolbelt MultipartEncoder) that urllib3
+    can rewind for retries: seek(0) re-encodes from the start of each file.
+    """
+
+    def __init__(self, fields: dict):
+        from requests_toolbelt import MultipartEncoder
+
+        self._encoder_class = MultipartEncoder
+        self._fields = fields
+        self._boundary = None
+        self.seek(0)
+        self.content_type = self._encoder.content_type
+        self.len = self._encoder.len
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._encoder.read(size)
+        self._position += len(chunk)
+        return chunk
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset != 0 or whence != 0:
+            raise OSError("multipart upload can only be rewound to the start")
+        for value in self._fields.values():
+            if isinstance(value, tuple):
+                value[1].seek(0)
+        # Keep the boundary stable so it still matches the Content-Type header
+        self._encoder = self._encoder_class(self._fields, boundary=self._boundary)
+        self._boundary = self._encoder.boundary_value
+        self._position = 0
+        return 0
+
+
+def _multipart_upload(fields: dict):
+    """Build a streamed multipart body, or None if requests-toolbelt isn't installed."""
+    try:
+        import requests_toolbelt  # noqa: F401
     except ImportError:
-        raise ImportError("requests not installed. Run: pip install requests")
+        return None
+    return _MultipartUpload(fields)
 
-    if not OPENROUTER_API_KEY:
-        raise ValueError("OPENROUTER_API_KEY not set")
+
+def _post(url: str, api_key: str, content: bytes = None, json_body: dict = None,
+          files: dict = None, data: dict = None):
+    """
+    POST to an API over the pooled client for its key, raising on error responses.
+
+    content is a pre-serialized JSON body. Uses HTTP/2 via httpx when
+    IMAGEGEN_HTTP2=1, otherwise the requests session (streamed, so the body
+    can be parsed incrementally by _first_json_item).
+    """
+    _wait_for_prewarm(api_key)
+
+    if not HTTP2_ENABLED:
+        body = content if content is not None else data
+        headers = None
+        if files:
+            upload = _multipart_upload({**(data or {}), **files})
+            if upload is not None:
+                body, files = upload, None
+                headers = {"Content-Type": upload.content_type}
+            else:
+                # Drop the session's JSON Content-Type so requests sets the multipart boundary
+                headers = {"Content-Type": None}
+        response = _get_session(api_key).post(
+            url,
+            data=body,
+            json=json_body,
+            files=files,
+            headers=headers,
+            timeout=120,
+            stream=True,
+        )
+        _raise_for_status(response)
+        return response
+
+    import time
+    import httpx
+
+    client = _get_http2_client(api_key)
+    headers = {"Content-Type": "application/json"} if content is not None else None
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = client.post(url, content=content, json=json_body, files=files, data=data,
+                                   headers=headers)
+        except httpx.TransportError:
+            # Read timeouts and dropped connections aren't covered by transport retries
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+            break
+        time.sleep(_retry_delay(attempt, response.headers.get("Retry-After")))
+
+    _raise_for_status(response)
+    return response
+
+
+def _openrouter_body(prompt: str, model: str, input_image: str = None,
+                     aspect_ratio: str = None, image_size: str = None) -> bytes:
+    """Build the serialized OpenRouter chat completion request body."""
+    # The input image is spliced into the serialized JSON as raw bytes, so the
+    # encoder never walks (or copies) the megabytes-long base64 string
+    placeholder = "__IMAGE_GEN_INPUT_IMAGE__"
 
     # Build message content
     content = []
     if input_image:
-        img_data, mime_type = image_to_base64(input_image)
         content.append({
             "type": "image_url",
-            "image_url": {"url": f"data:{mime_type};base64,{img_data}"}
+            "image_url": {"url": placeholder}
         })
     content.append({"type": "text", "text": prompt})
 
@@ -193,34 +612,52 @@ def generate_openrouter(prompt: str, model: str, input_image: str = None,
         if image_size:
             payload["image_config"]["image_size"] = image_size
 
-    # Retry loop for transient network/SSL errors
-    last_error = None
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json=payload,
-                timeout=120,
-            )
-            response.raise_for_status()
-            break
-        except requests.exceptions.RequestException as e:
-            last_error = e
-            if attempt < MAX_RETRIES - 1:
-                wait_time = RETRY_BACKOFF_BASE ** attempt
-                print(f"  Retry {attempt + 1}/{MAX_RETRIES} after {wait_time}s: {e}")
-                time.sleep(wait_time)
-            else:
-                raise last_error
+    body = _json_dumps(payload)
+    if not input_image:
+        return body
+
+    # The image part precedes the prompt text, so the first match is the placeholder
+    img_data, mime_type = image_to_base64(input_image)
+    head, tail = body.split(placeholder.encode("ascii"), 1)
+    return b"".join([head, f"data:{mime_type};base64,".encode("ascii"), img_data, tail])
 
-    result = response.json()
 
-    # Extract image from response
-    message = result["choices"][0]["message"]
+def _first_json_item(response, prefix: str):
+    """
+    Return the first JSON value at an ijson-style prefix (e.g. "data.item.b64_json")
+    in a streamed response, or None if it isn't there.
+
+    With ijson installed the body is parsed straight off the socket, so the raw
+    response bytes are never buffered alongside the extracted value.
+    """
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    # httpx responses (HTTP/2 mode) are already read, so just parse them
+    if ijson is None or not hasattr(response, "raw"):
+        value = _json_loads(response.content)
+        try:
+            for key in prefix.split("."):
+                value = value[0] if key == "item" else value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return value
+
+    response.raw.decode_content = True  # Undo gzip/deflate like response.content would
+    items = ijson.items(response.raw, prefix, use_float=True)
+    value = next(items, None)
+    # Drain the rest of the body so the connection goes back to the keep-alive pool
+    for _ in items:
+        pass
+    return value
+
+
+def _extract_openrouter_image(message: dict) -> str:
+    """Extract the generated image from an OpenRouter response message."""
+    if not isinstance(message, dict):
+        raise ValueError("No message in response")
 
     if "images" in message and message["images"]:
         img = message["images"][0]
@@ -241,84 +678,67 @@ def generate_openrouter(prompt: str, model: str, input_image: str = None,
     raise ValueError(f"No image in response. Message keys: {message.keys()}")
 
 
+def _openai_payload(prompt: str, model: str, size: str = "auto", quality: str = "auto",
+                    output_format: str = "png", background: str = "auto") -> dict:
+    """Build the OpenAI image generation payload."""
+    return {
+        "model": model,
+        "prompt": prompt,
+        "size": size,
+        "quality": quality,
+        "output_format": output_format,
+        "background": background,
+        "n": 1,
+    }
+
+
+def generate_openrouter(prompt: str, model: str, input_image: str = None,
+                         aspect_ratio: str = None, image_size: str = None) -> str:
+    """Generate image using OpenRouter (Gemini models)."""
+    if not OPENROUTER_API_KEY:
+        raise ValueError("OPENROUTER_API_KEY not set")
+
+    body = _openrouter_body(prompt, model, input_image, aspect_ratio, image_size)
+
+    response = _post(OPENROUTER_URL, OPENROUTER_API_KEY, content=body)
+
+    return _extract_openrouter_image(_first_json_item(response, "choices.item.message"))
+
+
 def generate_openai(prompt: str, model: str, input_image: str = None,
                     size: str = "auto", quality: str = "auto",
                     output_format: str = "png", background: str = "auto") -> str:
     """Generate image using direct OpenAI API."""
-    try:
-        import requests
-    except ImportError:
-        raise ImportError("requests not installed. Run: pip install requests")
-
     if not OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY not set")
 
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    # Retry loop for transient network/SSL errors
-    last_error = None
-    for attempt in range(MAX_RETRIES):
-        try:
-            if input_image:
-                # Image edit endpoint
-                with open(input_image, "rb") as f:
-                    files = {"image": f}
-                    data = {
-                        "model": model,
-                        "prompt": prompt,
-                        "size": size,
-                    }
-                    response = requests.post(
-                        "https://api.openai.com/v1/images/edits",
-                        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-                        files=files,
-                        data=data,
-                        timeout=120,
-                    )
-            else:
-                # Image generation endpoint
-                payload = {
-                    "model": model,
-                    "prompt": prompt,
-                    "size": size,
-                    "quality": quality,
-                    "output_format": output_format,
-                    "background": background,
-                    "n": 1,
-                }
-                response = requests.post(
-                    "https://api.openai.com/v1/images/generations",
-                    headers=headers,
-                    json=payload,
-                    timeout=120,
-                )
-            response.raise_for_status()
-            break
-        except requests.exceptions.RequestException as e:
-            last_error = e
-            if attempt < MAX_RETRIES - 1:
-                wait_time = RETRY_BACKOFF_BASE ** attempt
-                print(f"  Retry {attempt + 1}/{MAX_RETRIES} after {wait_time}s: {e}")
-                time.sleep(wait_time)
-            else:
-                raise last_error
-
-    result = response.json()
-
-    return result["data"][0]["b64_json"]
+    if input_image:
+        # Image edit endpoint
+        with open(input_image, "rb") as f:
+            mime_type = IMAGE_MIME_TYPES.get(Path(input_image).suffix.lower(), "image/png")
+            # File parts are streamed from disk instead of buffered into the request body
+            files = {"image": (Path(input_image).name, f, mime_type)}
+            data = {
+                "model": model,
+                "prompt": prompt,
+                "size": size,
+            }
+            response = _post(OPENAI_EDITS_URL, OPENAI_API_KEY, files=files, data=data)
+    else:
+        # Image generation endpoint
+        payload = _openai_payload(prompt, model, size, quality, output_format, background)
+        response = _post(OPENAI_GENERATIONS_URL, OPENAI_API_KEY, json_body=payload)
 
+    # Pull only the base64 string out of the body; save_image decodes it in chunks
+    b64_json = _first_json_item(response, "data.item.b64_json")
+    if b64_json is None:
+        raise ValueError("No image in response")
+    return b64_json
 
-def generate(prompt: str, model_alias: str = None, input_image: str = None,
-             output_dir: str = None, aspect_ratio: str = None,
-             image_size: str = None, size: str = "auto",
-             transparent: bool = False, fast: bool = False) -> str:
-    """Main generation function."""
-    session = load_session()
 
-    # Resolve model - use smart selection if not explicitly specified
+def _resolve_model(prompt: str, model_alias: str = None, transparent: bool = False,
+                   fast: bool = False, image_size: str = None) -> str:
+    """Resolve a model alias, using smart selection if not explicitly specified."""
     if model_alias is None or model_alias == "auto":
         model_alias = select_model(prompt, transparent=transparent, fast=fast,
                                    high_res=(image_size == "4K"))
@@ -328,21 +748,40 @@ def generate(prompt: str, model_alias: str = None, input_image: str = None,
         available = ", ".join(MODELS.keys())
         raise ValueError(f"Unknown model '{model_alias}'. Available: {available}")
 
-    model = MODELS[model_alias]
-    is_openai = model_alias.startswith("gpt-")
+    return model_alias
+
 
-    # Resolve output directory
+def _resolve_output_dir(session: dict, output_dir: str = None) -> Path:
+    """Resolve the output directory, remembering it in the session."""
     if output_dir:
         out_path = Path(output_dir).expanduser().resolve()
         session["output_dir"] = str(out_path)
     elif session.get("output_dir"):
         out_path = Path(session["output_dir"])
     else:
-        out_path = Path.cwd() / "generated-images"
+        out_path = get_project_dir() / "generated-images"
         session["output_dir"] = str(out_path)
+    return out_path
+
+
+def generate(prompt: str, model_alias: str = None, input_image: str = None,
+             output_dir: str = None, aspect_ratio: str = None,
+             image_size: str = None, size: str = "auto",
+             transparent: bool = False, fast: bool = False,
+             use_current_image: bool = True) -> str:
+    """Main generation function."""
+    from datetime import datetime
+
+    session = load_session()
+
+    model_alias = _resolve_model(prompt, model_alias, transparent, fast, image_size)
+    model = MODELS[model_alias]
+    is_openai = model_alias.startswith("gpt-")
+
+    out_path = _resolve_output_dir(session, output_dir)
 
     # Use current image for edit if no input specified
-    if input_image is None and session.get("current_image"):
+    if input_image is None and use_current_image and session.get("current_image"):
         input_image = session["current_image"]
 
     # Generate
@@ -361,19 +800,321 @@ def generate(prompt: str, model_alias: str = None, input_image: str = None,
     print(f"Saved: {saved_path}")
 
     # Update session
-    session["current_image"] = str(saved_path)
-    session["history"].append({
+    # History first, so a failed session write can't drop the saved image's record
+    append_history([{
         "prompt": prompt,
         "model": model_alias,
         "input": input_image,
         "output": str(saved_path),
         "timestamp": datetime.now().isoformat(),
-    })
+    }])
+    session["current_image"] = str(saved_path)
     save_session(session)
 
     return str(saved_path)
 
 
+# === Batch Generation ===
+# Fans out independent generations concurrently over one connection pool: aiohttp,
+# or an HTTP/2 httpx.AsyncClient when IMAGEGEN_HTTP2=1.
+# asyncio is imported inside these functions so single-image runs don't pay for it.
+
+async def _send_async(http, url: str, headers: dict, body: bytes = None,
+                      form: dict = None) -> tuple:
+    """Send one POST over the batch client, returning (status, reason, headers, content)."""
+    if HTTP2_ENABLED:
+        data = files = None
+        if form is not None:
+            data = {name: value for name, value in form.items() if not isinstance(value, tuple)}
+            files = {name: value for name, value in form.items() if isinstance(value, tuple)}
+        response = await http.post(url, headers=headers, content=body, data=data, files=files)
+        return response.status_code, response.reason_phrase, response.headers, response.content
+
+    import aiohttp
+
+    # Multipart bodies can only be sent once, so the form is rebuilt per attempt
+    data = body
+    if form is not None:
+        data = aiohttp.FormData()
+        for name, value in form.items():
+            if isinstance(value, tuple):
+                filename, content, content_type = value
+                data.add_field(name, content, filename=filename, content_type=content_type)
+            else:
+                data.add_field(name, value)
+
+    async with http.post(url, headers=headers, data=data,
+                         timeout=aiohttp.ClientTimeout(total=120)) as response:
+        return response.status, response.reason, response.headers, await response.read()
+
+
+def _transient_errors() -> tuple:
+    """Exception types worth retrying for the active batch client."""
+    import asyncio
+
+    if HTTP2_ENABLED:
+        import httpx
+        return (httpx.TransportError,)
+
+    import aiohttp
+    return (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+async def _post_async(http, url: str, api_key: str, body: bytes = None,
+                      form: dict = None) -> dict:
+    """POST a JSON body or multipart form with retries, returning the parsed JSON."""
+    import asyncio
+
+    headers = {"Authorization": f"Bearer {api_key}"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    transient_errors = _transient_errors()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            status, reason, response_headers, content = await _send_async(
+                http, url, headers, body, form)
+            if status not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                if status >= 400:
+                    raise RuntimeError(f"{status} {reason} for url: "
+                                       f"{url}: {_error_detail(content)}")
+                return _json_loads(content)
+            delay = _retry_delay(attempt, response_headers.get("Retry-After"))
+        except transient_errors:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+        await asyncio.sleep(delay)
+
+
+async def _generate_openrouter_async(http, prompt: str, model: str, input_image: str = None,
+                                     aspect_ratio: str = None, image_size: str = None) -> str:
+    """Async variant of generate_openrouter for batch runs."""
+    import asyncio
+
+    if not OPENROUTER_API_KEY:
+        raise ValueError("OPENROUTER_API_KEY not set")
+
+    body = await asyncio.to_thread(_openrouter_body, prompt, model, input_image,
+                                   aspect_ratio, image_size)
+    result = await _post_async(http, OPENROUTER_URL, OPENROUTER_API_KEY, body=body)
+    return _extract_openrouter_image(result["choices"][0]["message"])
+
+
+async def _generate_openai_async(http, prompt: str, model: str, input_image: str = None,
+                                 size: str = "auto") -> str:
+    """Async variant of generate_openai for batch runs."""
+    import asyncio
+
+    if not OPENAI_API_KEY:
+        raise ValueError("OPENAI_API_KEY not set")
+
+    if input_image:
+        path = Path(input_image)
+        image = await asyncio.to_thread(path.read_bytes)
+        mime_type = IMAGE_MIME_TYPES.get(path.suffix.lower(), "image/png")
+        form = {"model": model, "prompt": prompt, "size": size,
+                "image": (path.name, image, mime_type)}
+        result = await _post_async(http, OPENAI_EDITS_URL, OPENAI_API_KEY, form=form)
+    else:
+        body = _json_dumps(_openai_payload(prompt, model, size))
+        result = await _post_async(http, OPENAI_GENERATIONS_URL, OPENAI_API_KEY, body=body)
+    return result["data"][0]["b64_json"]
+
+
+async def _generate_async(http, item: dict, out_path: Path) -> dict:
+    """Run one batch item and save its image, returning the history entry."""
+    import asyncio
+    from datetime import datetime
+
+    prompt = item["prompt"]
+    model_alias = _resolve_model(prompt, item.get("model"), item.get("transparent", False),
+                                 item.get("fast", False), item.get("image_size"))
+    model = MODELS[model_alias]
+    input_image = item.get("input")
+
+    if model_alias.startswith("gpt-"):
+        base64_data = await _generate_openai_async(http, prompt, model, input_image,
+                                                   size=item.get("size", "auto"))
+    else:
+        base64_data = await _generate_openrouter_async(http, prompt, model, input_image,
+                                                       item.get("aspect_ratio"),
+                                                       item.get("image_size"))
+
+    saved_path = await asyncio.to_thread(save_image, base64_data, out_path)
+    print(f"Saved: {saved_path}")
+
+    return {
+        "prompt": prompt,
+        "model": model_alias,
+        "input": input_image,
+        "output": str(saved_path),
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+def _batch_concurrency() -> int:
+    """Read IMAGEGEN_CONCURRENCY (default 5), rejecting values below 1."""
+    value = os.getenv("IMAGEGEN_CONCURRENCY", "5")
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise ValueError(f"IMAGEGEN_CONCURRENCY must be a positive integer, got {value!r}")
+    return concurrency
+
+
+async def _batch(items: list[dict], out_path: Path) -> list:
+    """Generate all batch items concurrently, bounded by IMAGEGEN_CONCURRENCY."""
+    import asyncio
+
+    semaphore = asyncio.Semaphore(_batch_concurrency())
+
+    if HTTP2_ENABLED:
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("httpx not installed. Run: pip install 'httpx[http2]'")
+
+        limits = httpx.Limits(max_connections=8, max_keepalive_connections=8)
+        client = httpx.AsyncClient(http2=True, limits=limits, timeout=120)
+    else:
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("aiohttp not installed. Run: pip install aiohttp")
+
+        connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=75)
+        client = aiohttp.ClientSession(connector=connector)
+
+    async with client as http:
+        async def run(item):
+            async with semaphore:
+                return await _generate_async(http, item, out_path)
+
+        return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+
+def read_batch_file(prompt_file: str) -> list[dict]:
+    """
+    Read batch items from a file.
+
+    Each non-empty line is either a plain prompt or a JSON object with a
+    "prompt" key plus optional per-item options (model, input, aspect_ratio,
+    image_size, size, transparent, fast). Lines starting with # are skipped.
+    """
+    items = []
+    with open(prompt_file) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                item = _json_loads(line)
+                if not item.get("prompt"):
+                    raise ValueError(f"{prompt_file}:{line_no}: missing 'prompt'")
+            else:
+                item = {"prompt": line}
+            items.append(item)
+    return items
+
+
+# Batch item option -> generate() keyword argument
+BATCH_ITEM_OPTIONS = {
+    "prompt": "prompt",
+    "model": "model_alias",
+    "input": "input_image",
+    "aspect_ratio": "aspect_ratio",
+    "image_size": "image_size",
+    "size": "size",
+    "transparent": "transparent",
+    "fast": "fast",
+}
+
+
+def generate_many(prompts: list, **kwargs) -> list[str]:
+    """
+    Generate one new image per prompt in parallel threads.
+
+    Each prompt is a string or a batch item dict (see read_batch_file); item
+    options override the shared generate() keyword arguments. Prompts never
+    implicitly edit the current session image. Returns saved paths in input order.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not prompts:
+        return []
+
+    # Load once here so a legacy inline history is migrated before workers start;
+    # otherwise every thread would see it and append it to the log again
+    load_session()
+
+    calls = []
+    for prompt in prompts:
+        item = prompt if isinstance(prompt, dict) else {"prompt": prompt}
+        options = {BATCH_ITEM_OPTIONS[key]: value for key, value in item.items()
+                   if key in BATCH_ITEM_OPTIONS}
+        calls.append({**kwargs, "use_current_image": False, **options})
+
+    # requests releases the GIL while waiting on the socket, so threads overlap fully
+    max_workers = max(1, min(_batch_concurrency(), len(calls)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(generate, **call) for call in calls]
+
+    saved = []
+    failed = 0
+    for call, future in zip(calls, futures):
+        try:
+            saved.append(future.result())
+        except Exception as e:
+            failed += 1
+            print(f"  Failed: {call['prompt'][:50]}: {e}", file=sys.stderr)
+
+    if failed:
+        raise RuntimeError(f"{failed} of {len(calls)} generations failed")
+    return saved
+
+
+def generate_batch(prompt_file: str, model_alias: str = None,
+                   output_dir: str = None, backend: str = "async") -> list[str]:
+    """Generate one new image per batch item concurrently."""
+    import asyncio
+
+    items = read_batch_file(prompt_file)
+    if not items:
+        raise ValueError(f"No prompts found in {prompt_file}")
+    if model_alias:
+        for item in items:
+            item.setdefault("model", model_alias)
+
+    if backend == "threads":
+        print(f"Generating {len(items)} images...")
+        return generate_many(items, output_dir=output_dir)
+
+    session = load_session()
+    out_path = _resolve_output_dir(session, output_dir)
+
+    print(f"Generating {len(items)} images...")
+    results = asyncio.run(_batch(items, out_path))
+
+    entries = []
+    failed = 0
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"  Failed: {item['prompt'][:50]}: {result}", file=sys.stderr)
+            continue
+        entries.append(result)
+    append_history(entries)
+    if entries:
+        session["current_image"] = entries[-1]["output"]
+    save_session(session)
+
+    if failed:
+        raise RuntimeError(f"{failed} of {len(items)} generations failed")
+    return [entry["output"] for entry in entries]
+
+
 def show_status():
     """Show current session status."""
     session_file = get_session_file()
@@ -382,13 +1123,29 @@ def show_status():
     print(f"Session file: {session_file}")
     print(f"Current image: {session.get('current_image', 'None')}")
     print(f"Output dir: {session.get('output_dir', 'Not set (will ask)')}")
-    print(f"History: {len(session.get('history', []))} generations")
-    if session.get("history"):
-        last = session["history"][-1]
+    count, last = read_history_summary()
+    print(f"History: {count} generations")
+    if last:
         print(f"Last: {last['model']} - {last['prompt'][:50]}...")
 
 
 def main():
+    # Argument-free commands are dispatched before argparse is even imported
+    simple_commands = {"status": show_status, "s": show_status,
+                       "clear": clear_session, "c": clear_session}
+    if len(sys.argv) == 2 and sys.argv[1] in simple_commands:
+        try:
+            simple_commands[sys.argv[1]]()
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    # Start the TLS handshake now so it overlaps argparse and session loading
+    _prewarm_from_argv(sys.argv[1:])
+
+    import argparse
+
     parser = argparse.ArgumentParser(description="Generate images with AI models")
     subparsers = parser.add_subparsers(dest="command", help="Commands")
 
@@ -422,6 +1179,16 @@ def main():
     edit_parser.add_argument("--fast", action="store_true",
                            help="Fast mode for drafts")
 
+    # Batch command
+    batch_parser = subparsers.add_parser("batch", aliases=["b"],
+                                          help="Generate images for many prompts concurrently")
+    batch_parser.add_argument("prompts", help="File with one prompt per line (or JSONL with options)")
+    batch_parser.add_argument("-m", "--model", choices=["auto"] + list(MODELS.keys()),
+                             default="auto", help="Default model (auto = smart selection)")
+    batch_parser.add_argument("-o", "--output", help="Output directory")
+    batch_parser.add_argument("--backend", choices=["async", "threads"], default="async",
+                             help="Concurrency backend (threads needs no aiohttp)")
+
     # Status command
     subparsers.add_parser("status", aliases=["s"], help="Show session status")
 
@@ -459,6 +1226,15 @@ def main():
             )
             print(f"\nEdited: {result}")
 
+        elif args.command in ("batch", "b"):
+            results = generate_batch(
+                prompt_file=args.prompts,
+                model_alias=args.model if args.model != "auto" else None,
+                output_dir=args.output,
+                backend=args.backend,
+            )
+            print(f"\nGenerated {len(results)} images")
+
         elif args.command in ("status", "s"):
             show_status()
 
@@ -466,9 +1242,7 @@ def main():
             clear_session()
 
         elif args.command == "set-dir":
-            session = load_session()
-            session["output_dir"] = str(Path(args.directory).expanduser().resolve())
-            save_session(session)
+            session = update_session(output_dir=str(Path(args.directory).expanduser().resolve()))
             print(f"Output directory set to: {session['output_dir']}")
 
         else: